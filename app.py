@@ -6,8 +6,8 @@ import pandas as pd
 import subprocess
 import os
 import json
-from fpdf import FPDF
-from fpdf.enums import XPos, YPos # Needed for new FPDF version
+from exporter import export_key, get_csv_bytes, get_pdf_bytes, retry_pdf
+from retry_queue import queue_stats, recovered_file
 
 #-------------------------------------------------------------------------------#
 # INSTALLATION & SYSTEM CONFIG
@@ -42,33 +42,6 @@ def get_demo_data(category, city, count): # Add count parameter
     # Return only the number of leads requested by the user
     return full_list[:count]
 
-def create_pdf_report(df, category, city):
-    """Generates a professional PDF Lead Audit with updated FPDF2 syntax"""
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("helvetica", 'B', 20)
-    pdf.cell(0, 20, "Gentleman Solutions - Lead Audit", 
-             new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
-    
-    pdf.set_font("helvetica", 'I', 12)
-    pdf.cell(0, 10, f"Target Industry: {category} | Location: {city}", 
-             new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
-    pdf.ln(10)
-    
-    # Table Header
-    pdf.set_fill_color(200, 220, 255)
-    pdf.set_font("helvetica", 'B', 12)
-    pdf.cell(90, 10, "Business Name", border=1, fill=True)
-    pdf.cell(100, 10, "Contact Email", border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, fill=True)
-    
-    # Table Body
-    pdf.set_font("helvetica", '', 10)
-    for _, row in df.iterrows():
-        pdf.cell(90, 10, str(row['name'])[:45], border=1)
-        pdf.cell(100, 10, str(row['email']), border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-    
-    return pdf.output()
-
 def save_session_to_disk():
     session_data = {
         "email_val": st.session_state.get("email_val"),
@@ -185,6 +158,16 @@ if st.button("⚡ Start Lead Engine", width="stretch"):
                 if os.path.exists(output_file):
                     st.session_state["leads_df"] = pd.read_csv(output_file)
                     st.session_state["is_real_data"] = True
+
+                # Retry failed crawls/sends in the background instead of losing the leads
+                # (the drain only touches this sender's items, so it can't use the wrong password)
+                pending = queue_stats(st.session_state.email_val)["pending"]
+                if pending:
+                    subprocess.Popen([
+                        sys.executable, "scraper.py", "--drain",
+                        st.session_state.email_val, st.session_state.pass_val
+                    ])
+                    st.info(f"♻️ {pending} failed item(s) are being retried in the background.")
             except Exception as e:
                 st.error(f"Engine Error: {e}")
 
@@ -201,11 +184,58 @@ if "leads_df" in st.session_state:
     st.subheader("📊 Extraction Results")
     st.dataframe(df, width="stretch")
     
-    col_dl1, col_dl2 = st.columns(2)
-    
-    # Export Options
-    csv_data = df.to_csv(index=False).encode('utf-8')
-    col_dl1.download_button("📥 Download Raw Data (CSV)", csv_data, "leads.csv", "text/csv", width="stretch")
-    
-    pdf_output = create_pdf_report(df, cat, city)
-    col_dl2.download_button("📜 Download Executive Audit (PDF)", bytes(pdf_output), "Lead_Audit.pdf", "application/pdf", width="stretch")
\ No newline at end of file
+    # Export Options (served from the content-hash cache, so reruns are instant)
+    export_id = export_key(df, cat, city)
+    csv_data = get_csv_bytes(df, export_id)
+
+    def load_pdf():
+        """Returns (pdf bytes or None while rendering, render error or None)."""
+        try:
+            return get_pdf_bytes(df, cat, city, export_id), None
+        except Exception as e:
+            return None, e
+
+    pdf_output, pdf_error = load_pdf()
+    pdf_pending = pdf_output is None and pdf_error is None
+
+    # Poll only while a large PDF is still rendering in the background
+    @st.fragment(run_every=1 if pdf_pending else None)
+    def render_downloads():
+        pdf_bytes, render_error = load_pdf()
+        if pdf_pending and (pdf_bytes is not None or render_error is not None):
+            # Finished: one full rerun rebuilds this fragment without polling
+            st.rerun()
+        col_dl1, col_dl2 = st.columns(2)
+        col_dl1.download_button("📥 Download Raw Data (CSV)", csv_data, "leads.csv", "text/csv", width="stretch")
+        if pdf_bytes is not None:
+            col_dl2.download_button("📜 Download Executive Audit (PDF)", pdf_bytes, "Lead_Audit.pdf", "application/pdf", width="stretch")
+        elif render_error is not None:
+            col_dl2.error(str(render_error))
+            if col_dl2.button("🔁 Retry PDF Export", width="stretch"):
+                retry_pdf(export_id)
+                st.rerun()
+        else:
+            col_dl2.button("⏳ Rendering Executive Audit (PDF)...", disabled=True, width="stretch")
+
+    render_downloads()
+
+#-------------------------------------------------------------------------------#
+# RETRY QUEUE
+#-------------------------------------------------------------------------------#
+if st.session_state["logged_in"]:
+    queue = queue_stats(st.session_state.email_val)
+    recovered_path = recovered_file(st.session_state.email_val)
+    recovered_df = pd.read_csv(recovered_path) if os.path.exists(recovered_path) else pd.DataFrame()
+
+    if queue["pending"] or queue["dead"] or not recovered_df.empty:
+        st.divider()
+        st.subheader("♻️ Retry Queue")
+        m1, m2, m3 = st.columns(3)
+        m1.metric("Waiting for Retry", queue["pending"])
+        m2.metric("Recovered Leads", len(recovered_df))
+        m3.metric("Failed for Good", queue["dead"])
+
+        if not recovered_df.empty:
+            st.caption("Leads recovered by the background retry after the main campaign finished.")
+            st.dataframe(recovered_df, width="stretch")
+        st.button("🔄 Refresh Retry Status")
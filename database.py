@@ -51,6 +51,27 @@ def lead_is_new_for_this_sender(business_name, user_id):
         print(f"⚠️ Database Check Error: {e}")
         # In case of error, we assume it's new so the scraper doesn't stop
         return True
+
+def email_is_new_for_this_sender(email, user_id):
+    """
+    Checks whether this user already has a lead with this email address
+    (under any business name) linked to their dashboard.
+    Unlike the name check this raises on errors: the retry drain would
+    rather try again later than risk a duplicate cold email.
+    """
+    leads = supabase.table("global_leads") \
+        .select("id") \
+        .eq("email", email) \
+        .execute()
+    if not leads.data:
+        return True
+
+    response = supabase.table("user_leads") \
+        .select("id") \
+        .eq("user_id", user_id) \
+        .in_("lead_id", [lead['id'] for lead in leads.data]) \
+        .execute()
+    return len(response.data) == 0
     
 def check_db_for_name(business_name):
     """
@@ -0,0 +1,165 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos # Needed for new FPDF version
+
+#-------------------------------------------------------------------------------#
+# CONFIGURATION
+#-------------------------------------------------------------------------------#
+# How many rendered exports we keep around (one entry per dataset/category/city)
+MAX_CACHED_EXPORTS = 8
+
+# Reports bigger than this are rendered in the background thread
+BACKGROUND_ROW_THRESHOLD = 200
+
+# Table rows per PDF page (the first page also carries the title block)
+FIRST_PAGE_ROWS = 20
+ROWS_PER_PAGE = 25
+
+_cache = OrderedDict()
+_cache_lock = threading.RLock()
+_pdf_jobs = {}
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-export")
+
+#-------------------------------------------------------------------------------#
+# CACHE HELPERS
+#-------------------------------------------------------------------------------#
+def export_key(df, category, city):
+    """Builds a content hash of the leads DataFrame plus the report labels."""
+    digest = hashlib.sha256()
+    digest.update("|".join(map(str, df.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(f"{category}|{city}".encode('utf-8'))
+    return digest.hexdigest()
+
+def _cache_get(key):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    return None
+
+def _cache_put(key, value):
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_CACHED_EXPORTS:
+            _cache.popitem(last=False)
+
+#-------------------------------------------------------------------------------#
+# RENDERERS
+#-------------------------------------------------------------------------------#
+def _table_header(pdf):
+    pdf.set_fill_color(200, 220, 255)
+    pdf.set_font("helvetica", 'B', 12)
+    pdf.cell(90, 10, "Business Name", border=1, fill=True)
+    pdf.cell(100, 10, "Contact Email", border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, fill=True)
+    pdf.set_font("helvetica", '', 10)
+
+def create_pdf_report(df, category, city):
+    """Generates a professional PDF Lead Audit, one table page at a time."""
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("helvetica", 'B', 20)
+    pdf.cell(0, 20, "Gentleman Solutions - Lead Audit",
+             new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+
+    pdf.set_font("helvetica", 'I', 12)
+    pdf.cell(0, 10, f"Target Industry: {category} | Location: {city}",
+             new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+    pdf.ln(10)
+    _table_header(pdf)
+
+    # Column-wise string conversion instead of iterrows
+    names = df['name'].astype(str).str[:45].tolist()
+    emails = df['email'].astype(str).tolist()
+    rows = list(zip(names, emails))
+
+    start, page_size = 0, FIRST_PAGE_ROWS
+    while start < len(rows):
+        if start > 0:
+            pdf.add_page()
+            _table_header(pdf)
+        for name, email in rows[start:start + page_size]:
+            pdf.cell(90, 10, name, border=1)
+            pdf.cell(100, 10, email, border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        start += page_size
+        page_size = ROWS_PER_PAGE
+
+    return bytes(pdf.output())
+
+#-------------------------------------------------------------------------------#
+# PUBLIC API
+#-------------------------------------------------------------------------------#
+def get_csv_bytes(df, key):
+    """Returns the UTF-8 CSV export, encoding it only once per content hash."""
+    cached = _cache_get(("csv", key))
+    if cached is None:
+        cached = df.to_csv(index=False).encode('utf-8')
+        _cache_put(("csv", key), cached)
+    return cached
+
+def _cached_pdf(key):
+    """Returns the cached PDF bytes (or None); raises if this report already failed."""
+    with _cache_lock:
+        cached = _cache_get(("pdf", key))
+        if cached is not None:
+            return cached
+        error = _cache_get(("pdf_error", key))
+    if error is not None:
+        raise RuntimeError(f"PDF export failed: {error}")
+    return None
+
+def _render_pdf(df, category, city, key):
+    try:
+        data = create_pdf_report(df, category, city)
+    except Exception as e:
+        # Only the message is kept, so the failed render (and its DataFrame) can be freed
+        print(f"PDF export failed: {e}")
+        data, result = None, (("pdf_error", key), str(e) or type(e).__name__)
+    else:
+        result = (("pdf", key), data)
+
+    # Store the result and retire the job in one step, so no poll sees neither
+    with _cache_lock:
+        _cache_put(*result)
+        _pdf_jobs.pop(key, None)
+    return data
+
+def retry_pdf(key):
+    """Forgets a failed render so the next get_pdf_bytes call tries again."""
+    with _cache_lock:
+        _cache.pop(("pdf_error", key), None)
+
+def get_pdf_bytes(df, category, city, key):
+    """
+    Returns the cached PDF bytes, or None while a large report is still
+    being rendered in the background. Raises RuntimeError if this report
+    already failed, without rendering it again (see retry_pdf).
+    """
+    cached = _cached_pdf(key)
+    if cached is not None:
+        return cached
+
+    if len(df) <= BACKGROUND_ROW_THRESHOLD:
+        _render_pdf(df, category, city, key)
+        return _cached_pdf(key)
+
+    with _cache_lock:
+        # Check again: the worker may have finished since the read above
+        cached = _cached_pdf(key)
+        if cached is not None:
+            return cached
+        job = _pdf_jobs.get(key)
+        if job is None:
+            # Copy so later edits to the session DataFrame can't race the worker
+            job = _executor.submit(_render_pdf, df.copy(), category, city, key)
+            _pdf_jobs[key] = job
+
+    if job.done():
+        return _cached_pdf(key)
+    return None
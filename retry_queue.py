@@ -0,0 +1,238 @@
+import json
+import time
+import socket
+import sqlite3
+import smtplib
+from contextlib import contextmanager
+
+#-------------------------------------------------------------------------------#
+# CONFIGURATION
+#-------------------------------------------------------------------------------#
+QUEUE_DB = "retry_queue.db"
+
+# Retry policy per error class: (max attempts incl. the original one, base backoff in seconds)
+# Anything allowed only one attempt goes straight to the dead-letter table
+RETRY_POLICY = {
+    "timeout":  (5, 30),
+    "network":  (5, 30),
+    "dns":      (2, 300),
+    "blocked":  (4, 120),
+    "smtp_4xx": (5, 60),
+    "smtp_5xx": (1, 0),
+    "unknown":  (3, 60),
+}
+MAX_BACKOFF = 3600
+
+# How long a drain worker holds a claimed item before others may pick it up
+CLAIM_LEASE = 600
+
+# Drain mode gives up after this long, leaving the rest for the next run
+DRAIN_DEADLINE = 1800
+
+# Leads recovered by the drain, one file per sender so the dashboard can show them
+RECOVERED_FILE = "recovered_leads_{sender}.csv"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS retry_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    error_class TEXT NOT NULL,
+    error_message TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    error_class TEXT NOT NULL,
+    error_message TEXT,
+    attempts INTEGER NOT NULL,
+    failed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS campaigns (
+    campaign_id TEXT PRIMARY KEY,
+    remaining INTEGER NOT NULL
+);
+"""
+
+class BlockedError(Exception):
+    """Raised when a site answers with a rate limit, CAPTCHA or consent wall."""
+
+#-------------------------------------------------------------------------------#
+# ERROR CLASSIFICATION
+#-------------------------------------------------------------------------------#
+def classify_error(exc):
+    """Maps an exception to one of the RETRY_POLICY error classes."""
+    if isinstance(exc, BlockedError):
+        return "blocked"
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return "smtp_4xx" if 400 <= exc.smtp_code < 500 else "smtp_5xx"
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return "smtp_4xx" if codes and all(400 <= c < 500 for c in codes) else "smtp_5xx"
+    if isinstance(exc, socket.gaierror):
+        return "dns"
+    if isinstance(exc, (TimeoutError, socket.timeout)):
+        return "timeout"
+
+    # Playwright only gives us the message text
+    message = str(exc)
+    if "ERR_NAME_NOT_RESOLVED" in message or "getaddrinfo" in message:
+        return "dns"
+    if "Timeout" in message or "timed out" in message or "ERR_TIMED_OUT" in message:
+        return "timeout"
+    if isinstance(exc, (ConnectionError, smtplib.SMTPServerDisconnected)) or "ERR_CONNECTION" in message:
+        return "network"
+    return "unknown"
+
+def recovered_file(sender):
+    return RECOVERED_FILE.format(sender=sender)
+
+def backoff_delay(error_class, attempts):
+    _, base = RETRY_POLICY[error_class]
+    return min(MAX_BACKOFF, base * 2 ** (attempts - 1))
+
+#-------------------------------------------------------------------------------#
+# STORAGE
+#-------------------------------------------------------------------------------#
+@contextmanager
+def _db():
+    conn = sqlite3.connect(QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.executescript(SCHEMA)
+        yield conn
+    finally:
+        conn.close()
+
+def _dead_letter(conn, kind, sender, payload, error_class, message, attempts):
+    conn.execute(
+        "INSERT INTO dead_letters (kind, sender, payload, error_class, error_message, attempts, failed_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (kind, sender, payload, error_class, message, attempts, time.time()),
+    )
+    print(f"☠️  [DEAD LETTER] {kind} failed for good ({error_class}): {message}")
+
+def enqueue(kind, payload, exc, sender):
+    """
+    Records a failed lookup/crawl/send for a later retry (or dead-letters it).
+    `sender` is the Gmail the item belongs to; only a drain holding that
+    account's app password will pick it up.
+    """
+    error_class = classify_error(exc)
+    max_attempts, _ = RETRY_POLICY[error_class]
+    data = json.dumps(payload)
+    with _db() as conn:
+        if max_attempts <= 1:
+            _dead_letter(conn, kind, sender, data, error_class, str(exc), 1)
+            return error_class
+        conn.execute(
+            "INSERT INTO retry_queue (kind, sender, payload, error_class, error_message, attempts, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?, ?)",
+            (kind, sender, data, error_class, str(exc), time.time() + backoff_delay(error_class, 1), time.time()),
+        )
+    print(f"🔁 [RETRY QUEUED] {kind} ({error_class}): {exc}")
+    return error_class
+
+def claim_batch(limit, sender, now=None):
+    """Leases up to `limit` of the sender's due items so parallel drains don't double-process them."""
+    now = time.time() if now is None else now
+    with _db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT * FROM retry_queue WHERE sender = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (sender, now, limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE retry_queue SET next_attempt_at = ? WHERE id = ?",
+            [(now + CLAIM_LEASE, row["id"]) for row in rows],
+        )
+        conn.execute("COMMIT")
+    return [dict(row, payload=json.loads(row["payload"])) for row in rows]
+
+def mark_done(item):
+    with _db() as conn:
+        conn.execute("DELETE FROM retry_queue WHERE id = ?", (item["id"],))
+
+def mark_failed(item, exc):
+    """Reschedules a failed retry with exponential backoff, or dead-letters it."""
+    error_class = classify_error(exc)
+    attempts = item["attempts"] + 1
+    max_attempts, _ = RETRY_POLICY[error_class]
+    with _db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if attempts >= max_attempts:
+            conn.execute("DELETE FROM retry_queue WHERE id = ?", (item["id"],))
+            _dead_letter(conn, item["kind"], item["sender"], json.dumps(item["payload"]), error_class, str(exc), attempts)
+        else:
+            conn.execute(
+                "UPDATE retry_queue SET error_class = ?, error_message = ?, attempts = ?, next_attempt_at = ? WHERE id = ?",
+                (error_class, str(exc), attempts, time.time() + backoff_delay(error_class, attempts), item["id"]),
+            )
+        conn.execute("COMMIT")
+
+def next_due_at(sender):
+    with _db() as conn:
+        return conn.execute("SELECT MIN(next_attempt_at) FROM retry_queue WHERE sender = ?", (sender,)).fetchone()[0]
+
+def set_campaign_quota(campaign_id, remaining):
+    """Records how many more leads a campaign may still add (its Lead Count minus what it found)."""
+    with _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO campaigns (campaign_id, remaining) VALUES (?, ?)",
+            (campaign_id, max(0, remaining)),
+        )
+
+def take_campaign_slot(campaign_id):
+    """Uses up one of the campaign's remaining leads. False once the Lead Count is reached."""
+    with _db() as conn:
+        cursor = conn.execute(
+            "UPDATE campaigns SET remaining = remaining - 1 WHERE campaign_id = ? AND remaining > 0",
+            (campaign_id,),
+        )
+    return cursor.rowcount == 1
+
+def queue_stats(sender):
+    """Counts of the sender's items waiting for a retry and in the dead-letter table."""
+    with _db() as conn:
+        pending = conn.execute("SELECT COUNT(*) FROM retry_queue WHERE sender = ?", (sender,)).fetchone()[0]
+        dead = conn.execute("SELECT COUNT(*) FROM dead_letters WHERE sender = ?", (sender,)).fetchone()[0]
+    return {"pending": pending, "dead": dead}
+
+#-------------------------------------------------------------------------------#
+# DRAIN MODE
+#-------------------------------------------------------------------------------#
+def drain(handlers, sender, batch_size=10, deadline=DRAIN_DEADLINE, clock=time.time):
+    """
+    Re-runs the sender's queued items in batches until none are left or the
+    deadline passes. `handlers` maps a kind ("lookup", "crawl", "send") to a
+    function that takes the payload, raises on failure and returns True if it
+    actually saved or sent a lead. Returns the number of recovered leads.
+    """
+    stop_at = clock() + deadline
+    recovered = 0
+    while clock() < stop_at:
+        batch = claim_batch(batch_size, sender, now=clock())
+        if not batch:
+            wake_at = next_due_at(sender)
+            if wake_at is None:
+                break
+            # Sleep until the next backoff window opens (or we run out of time)
+            time.sleep(max(1, min(wake_at, stop_at) - clock()))
+            continue
+
+        for item in batch:
+            try:
+                saved = handlers[item["kind"]](item["payload"])
+            except Exception as e:
+                mark_failed(item, e)
+            else:
+                # Finished either way; only count it if a lead was really saved or sent
+                mark_done(item)
+                recovered += bool(saved)
+    return recovered
@@ -5,17 +5,35 @@ import sys
 import csv
 import time
 import json
+import uuid
 import sqlite3
 import pandas as pd
+from urllib.parse import quote_plus
 from send_autoemail import send_email
 from playwright.sync_api import sync_playwright
-from database import get_or_create_global_lead, link_lead_to_user, lead_is_new_for_this_sender, check_db_for_name
+from throttle import acquire, report_blocked, report_success
+from retry_queue import BlockedError, enqueue, drain, recovered_file, set_campaign_quota, take_campaign_slot
+from database import get_or_create_global_lead, link_lead_to_user, lead_is_new_for_this_sender, check_db_for_name, email_is_new_for_this_sender
 
 # This forces the script to ignore the terminal's old encoding 
 # and use UTF-8 for all print statements.
 if sys.stdout.encoding != 'utf-8':
     sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 
+# --- BLOCK DETECTION ---
+
+BLOCK_STATUSES = (429, 503)
+
+# How long to wait for new Maps cards after each feed scroll (ms)
+SCROLL_LOAD_TIMEOUT = 5000
+
+def page_is_blocked(page, response=None):
+    """Detects rate limits, CAPTCHAs and consent walls that mean we should slow down."""
+    if response is not None and response.status in BLOCK_STATUSES:
+        return True
+    url = page.url.lower()
+    return "/sorry/" in url or "captcha" in url or "consent.google." in url
+
 # --- EMAIL EXTRACTION ---
 
 def extract_email_from_page(page):
@@ -32,7 +50,10 @@ def extract_email_from_page(page):
 
 
 def find_email_on_website(browser, url):
-    """Visits the business website and looks for emails with image blocking for speed."""
+    """
+    Visits the business website and looks for emails with image blocking for speed.
+    Returns "N/A" when the site has no email; raises on failures so they can be retried.
+    """
     if not url or url == "N/A": return "N/A"
     
     context = browser.new_context(user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36")
@@ -46,7 +67,12 @@ def find_email_on_website(browser, url):
     
     try:
         # Reduced timeout to 15s because if it hasn't loaded by then, it's a "slow" lead
-        page.goto(url, timeout=15000, wait_until="domcontentloaded")
+        acquire(url)
+        response = page.goto(url, timeout=15000, wait_until="domcontentloaded")
+        if page_is_blocked(page, response):
+            report_blocked(url)
+            raise BlockedError(f"{url} answered with a rate limit or bot wall")
+        report_success(url)
         
         # --- COOKIE CRUSHER ---
         # --- IMPROVED COOKIE CRUSHER ---
@@ -78,6 +104,7 @@ def find_email_on_website(browser, url):
             for selector in ['a:has-text("Impressum")', 'a:has-text("Kontakt")', 'a:has-text("Contact")', 'a:has-text("Legal")']:
                 link = page.locator(selector).first
                 if link.is_visible():
+                    acquire(url)
                     link.click()
                     # Wait for the next page to actually load before scraping
                     page.wait_for_load_state("domcontentloaded")
@@ -88,14 +115,103 @@ def find_email_on_website(browser, url):
             email_found = results[0]
     except Exception as e:
         print(f"Error scraping {url}: {e}")
+        raise
     finally:
         page.close() # Close page specifically
         context.close()
     return email_found
 
+# --- GOOGLE MAPS ---
+
+def accept_google_consent(page):
+    """Flexible Google cookie wall handler."""
+    try:
+        # Wait for search box OR any accept button
+        page.wait_for_selector('button[aria-label*="Accept"], button:has-text("Accept all"), button:has-text("Alle akzeptieren"), input#searchboxinput', timeout=10000)
+        
+        accept_btn = page.locator('button:has-text("Accept all"), button:has-text("Alle akzeptieren"), button:has-text("I agree")').first
+        if accept_btn.is_visible():
+            accept_btn.click()
+            page.wait_for_load_state("networkidle")
+            time.sleep(1)
+    except:
+        print("No cookie wall found, checking for search box...")
+
+def same_business(a, b):
+    """Compares two business names, ignoring case and spacing."""
+    return " ".join(str(a).split()).casefold() == " ".join(str(b).split()).casefold()
+
+def lookup_website_on_maps(browser, name, city):
+    """
+    Re-finds a single business on Maps by name (used when a card failed before
+    we read its website). Returns "N/A" if it has no website or Maps only shows
+    other businesses; raises on failures.
+    """
+    context = browser.new_context(viewport={"width": 1920, "height": 1080})
+    page = context.new_page()
+    try:
+        acquire("google.com")
+        page.goto(f"https://www.google.com/maps/search/{quote_plus(f'{name} {city}')}", timeout=60000)
+        accept_google_consent(page)
+        if page_is_blocked(page):
+            report_blocked("google.com")
+            raise BlockedError(f"Google Maps blocked the lookup for {name}")
+
+        # Either Maps opens the place directly or it shows a results feed
+        page.wait_for_selector('a[data-item-id="authority"], div[role="feed"], h1', timeout=20000)
+        if page.locator('div[role="feed"]').count() > 0:
+            # Name searches often rank another business first: only open an exact match
+            match = None
+            for card in page.locator('div[role="article"]').all():
+                headline = card.locator('div.fontHeadlineSmall').first
+                if headline.count() > 0 and same_business(headline.inner_text(), name):
+                    match = card
+                    break
+            if match is None:
+                print(f"Maps lookup for {name} only found other businesses.")
+                return "N/A"
+            acquire("google.com")
+            match.click()
+
+        try:
+            page.wait_for_selector('a[data-item-id="authority"]', timeout=5000)
+        except Exception:
+            return "N/A"
+        report_success("google.com")
+
+        # Make sure the open place panel is really our business
+        titles = [title.inner_text() for title in page.locator('h1').all()]
+        if not any(same_business(title, name) for title in titles):
+            print(f"Maps lookup for {name} opened a different business.")
+            return "N/A"
+        return page.locator('a[data-item-id="authority"]').first.get_attribute("href") or "N/A"
+    finally:
+        page.close()
+        context.close()
+
+# --- LEAD STORAGE ---
+
+def save_lead(lead_info, user_id, output_file):
+    """Saves a lead to the global DB, links it to the user and appends it to the CSV."""
+    # 1. Save to Global DB and get the ID
+    global_id = get_or_create_global_lead(lead_info)
+
+    # 2. Link to the User (use the session user_id from Streamlit)
+    link_lead_to_user(user_id, global_id, lead_info['name'])
+    lead = {"name": lead_info['name'], "website": lead_info['website'], "email": lead_info['email']}
+    pd.DataFrame([lead]).to_csv(output_file, mode='a', header=not os.path.exists(output_file), index=False)
+    return lead
+
+def send_or_queue(payload, app_password):
+    """Sends one outreach email; failures go to the retry queue instead of being lost."""
+    try:
+        send_email(app_password=app_password, **payload)
+    except Exception as e:
+        enqueue("send", payload, e, payload['user_email'])
+
 # --- MAIN SCRAPER ---
 
-def run_scraper(max_results, output_file, category, city, search_query, sender_email, user_id):
+def run_scraper(max_results, output_file, category, city, search_query, sender_email, user_id, email_data=None):
     # Initialize CSV with Headers
     if os.path.exists(output_file):
         os.remove(output_file)
@@ -109,6 +225,23 @@ def run_scraper(max_results, output_file, category, city, search_query, sender_e
     collected_emails = set()  # To track emails and prevent duplicates
     results_count = 0
 
+    # Until the run finishes the drain may not add leads for this campaign
+    campaign_id = uuid.uuid4().hex
+    set_campaign_quota(campaign_id, 0)
+
+    def queue_retry(kind, e, **lead):
+        # Carry the sender, template and campaign so the drain emails from the
+        # right account and stays within the Lead Count
+        enqueue(kind, {
+            **lead,
+            "category": category,
+            "city": city,
+            "user_id": user_id,
+            "sender_email": sender_email,
+            "email_content": email_data,
+            "campaign_id": campaign_id
+        }, e, sender_email)
+
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
         # Standard context
@@ -116,20 +249,10 @@ def run_scraper(max_results, output_file, category, city, search_query, sender_e
         page = context.new_page()
         
         # Go to Maps
+        acquire("google.com")
         page.goto("https://www.google.com/maps", timeout=60000)
 
-        # --- FLEXIBLE GOOGLE COOKIE WALL HANDLER ---
-        try:
-            # Wait for search box OR any accept button
-            page.wait_for_selector('button[aria-label*="Accept"], button:has-text("Accept all"), button:has-text("Alle akzeptieren"), input#searchboxinput', timeout=10000)
-            
-            accept_btn = page.locator('button:has-text("Accept all"), button:has-text("Alle akzeptieren"), button:has-text("I agree")').first
-            if accept_btn.is_visible():
-                accept_btn.click()
-                page.wait_for_load_state("networkidle")
-                time.sleep(1)
-        except:
-            print("No cookie wall found, checking for search box...")
+        accept_google_consent(page)
 
         # --- SEARCH EXECUTION ---
         try:
@@ -153,6 +276,7 @@ def run_scraper(max_results, output_file, category, city, search_query, sender_e
 
             for card in cards:
                 if results_count >= max_results: break
+                name, website = None, None
                 
                 try:
                     # 1. Get the name safely
@@ -187,18 +311,35 @@ def run_scraper(max_results, output_file, category, city, search_query, sender_e
 
                     # 3. THE HARD WAY: If not in DB, click and scrape
                     print(f"🔍 Not in DB [SCRAPE] Processing: {name}")
+                    # Opening the place panel is a Maps request too: take a google.com slot
+                    acquire("google.com")
                     card.click()
                     try:
                         page.wait_for_selector('a[data-item-id="authority"]', timeout=2000)
+                        has_website = True
                     except:
+                        has_website = False
+
+                    if page_is_blocked(page):
+                        # Back off; the card handler below queues this lead for a retry
+                        report_blocked("google.com")
+                        raise BlockedError(f"Google Maps blocked the place panel for {name}")
+                    report_success("google.com")
+                    if not has_website:
                         continue
-                        
+
+                    # Let the new panel replace the previous one before reading its link
                     time.sleep(1)
 
                     web_locator = page.locator('a[data-item-id="authority"]').first
                     website = web_locator.get_attribute("href") if web_locator.count() > 0 else "N/A"
 
-                    email = find_email_on_website(browser, website)
+                    try:
+                        email = find_email_on_website(browser, website)
+                    except Exception as e:
+                        # Keep the lead: the drain mode re-crawls it later
+                        queue_retry("crawl", e, name=name, website=website)
+                        continue
                     
                     if email != "N/A" and email not in collected_emails:
                         # Inside your scraper loop after finding a lead:
@@ -209,14 +350,7 @@ def run_scraper(max_results, output_file, category, city, search_query, sender_e
                             "category": category,
                             "city": city
                         }
-
-                        # 1. Save to Global DB and get the ID
-                        global_id = get_or_create_global_lead(lead_info)
-
-                        # 2. Link to the User (use the session user_id from Streamlit)
-                        link_lead_to_user(user_id, global_id, name)
-                        lead = {"name": name, "website": website, "email": email}
-                        pd.DataFrame([lead]).to_csv(output_file, mode='a', header=False, index=False)
+                        lead = save_lead(lead_info, user_id, output_file)
                         
                         collected_emails.add(email)
                         results_list.append(lead)
@@ -225,21 +359,123 @@ def run_scraper(max_results, output_file, category, city, search_query, sender_e
 
                 except Exception as e:
                     print(f"Error processing card: {e}")
+                    if website and website != "N/A":
+                        queue_retry("crawl", e, name=name, website=website)
+                    elif name:
+                        # Failed before we read the website (DB or click timeout): re-find it by name
+                        queue_retry("lookup", e, name=name)
                     continue
             # Scroll feed to load more
             feed = page.locator('div[role="feed"]')
             if feed.count() > 0:
+                # Paced by the google.com budget instead of a fixed sleep
+                acquire("google.com")
+                loaded = len(cards)
                 feed.evaluate("el => el.scrollBy(0, 1000)")
-                time.sleep(2)
+                try:
+                    # Give the feed time to append new cards before we re-read them
+                    page.wait_for_function(
+                        "n => document.querySelectorAll('div[role=\"article\"]').length > n",
+                        arg=loaded, timeout=SCROLL_LOAD_TIMEOUT
+                    )
+                except Exception:
+                    # Nothing new yet (slow feed or end of the list)
+                    pass
+                if page_is_blocked(page):
+                    # The next acquire() waits out the backoff window
+                    report_blocked("google.com")
+                else:
+                    report_success("google.com")
             else:
                 # If feed is missing, we are probably lost or at the end
                 break
         
         browser.close()
+        # Whatever the run fell short of its Lead Count, the drain may still recover
+        set_campaign_quota(campaign_id, max_results - results_count)
         return results_list
 
+# --- DRAIN MODE ---
+
+def drain_failed_items(sender_email, app_password=None):
+    """
+    Re-runs the sender's queued lookups, crawls and sends in batches after the
+    main campaign finished. Only items queued by `sender_email` are touched, and
+    recovered leads never push a campaign past its Lead Count.
+    Returns the number of leads actually saved or emailed.
+    """
+    output_file = recovered_file(sender_email)
+
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+
+        def recover_lead(payload, website):
+            # The drain can run hours later: re-check what the main loop checks
+            if not lead_is_new_for_this_sender(payload['name'], payload['user_id']):
+                print(f"⏭️  [USER SKIP] {payload['name']} was added to your dashboard in the meantime.")
+                return False
+            email = find_email_on_website(browser, website)
+            if email == "N/A":
+                print(f"Retry for {payload['name']} loaded fine but found no email.")
+                return False
+            if not email_is_new_for_this_sender(email, payload['user_id']):
+                print(f"⏭️  [USER SKIP] {email} is already in your dashboard.")
+                return False
+            if not take_campaign_slot(payload.get('campaign_id')):
+                print(f"⏭️  [QUOTA] {payload['name']} skipped, the campaign already reached its Lead Count.")
+                return False
+
+            lead_info = {
+                "name": payload['name'],
+                "email": email,
+                "website": website,
+                "category": payload['category'],
+                "city": payload['city']
+            }
+            save_lead(lead_info, payload['user_id'], output_file)
+            print(f"♻️  [RECOVERED] {payload['name']} ({email})")
+
+            if app_password and payload.get('email_content'):
+                send_or_queue({
+                    "email": email,
+                    "business_name": payload['name'],
+                    "user_email": payload['sender_email'],
+                    "email_content": payload['email_content'],
+                    "city": payload['city']
+                }, app_password)
+            return True
+
+        def retry_lookup(payload):
+            website = lookup_website_on_maps(browser, payload['name'], payload['city'])
+            if website == "N/A":
+                print(f"Retry for {payload['name']} found no matching website on Maps.")
+                return False
+            return recover_lead(payload, website)
+
+        def retry_crawl(payload):
+            return recover_lead(payload, payload['website'])
+
+        def retry_send(payload):
+            if not app_password:
+                raise RuntimeError("No app password given to the drain, cannot resend")
+            send_email(app_password=app_password, **payload)
+            return True
+
+        recovered = drain({"lookup": retry_lookup, "crawl": retry_crawl, "send": retry_send}, sender_email)
+        browser.close()
+    return recovered
+
 
 if __name__ == "__main__":
+
+    # Background drain mode: scraper.py --drain <sender gmail> <app password>
+    if len(sys.argv) > 2 and sys.argv[1] == "--drain":
+        sender_email = sys.argv[2]
+        app_password = sys.argv[3] if len(sys.argv) > 3 else None
+        print(f"♻️  Draining retry queue for {sender_email}...")
+        recovered = drain_failed_items(sender_email, app_password)
+        print(f"✅ Drain complete. {recovered} lead(s) recovered, new leads saved to {recovered_file(sender_email)}.")
+        sys.exit(0)
     
     # 1. Define configuration
     if len(sys.argv) > 5:
@@ -264,7 +500,7 @@ if __name__ == "__main__":
 
     # 2. Run the Scraper
     print(f"🚀 Starting scrape for {query}...")
-    run_scraper(count, output_file, category, city, query, sender_email, user_id)
+    run_scraper(count, output_file, category, city, query, sender_email, user_id, email_data)
     print(f"✅ Scraping complete. Leads saved to {output_file}.")
 
     # 3. Trigger Emails Automatically
@@ -279,18 +515,14 @@ if __name__ == "__main__":
                 email = row['email'].strip()
                 
                 if email and email != "N/A":
-                    # Calling your imported function
-                    
-                    send_email(
-                    email=row['email'],           # to_email
-                    business_name=row['name'],            # business_name
-                    user_email=sender_email,    # your gmail
-                    app_password=app_password,    # your app pass
-                    email_content=email_data,  # the JSON dict, 
-                    city=city
-                )
-                    # 2026 Deliverability Tip: 5-10 seconds is safer for Gmail
-                    time.sleep(7) 
+                    # Calling your imported function (failures are queued for the drain)
+                    send_or_queue({
+                        "email": email,               # to_email
+                        "business_name": name,        # business_name
+                        "user_email": sender_email,   # your gmail
+                        "email_content": email_data,  # the JSON dict
+                        "city": city
+                    }, app_password)                  # your app pass
                 else:
                     print(f"Skipping {name}: No email found.")
     else:
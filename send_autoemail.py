@@ -2,6 +2,9 @@ import csv
 import smtplib
 import time
 from email.message import EmailMessage
+from throttle import acquire, report_blocked, report_success
+
+SMTP_HOST = 'smtp.gmail.com'
 
 # --- CONFIGURATION ---
 
@@ -11,7 +14,10 @@ from email.message import EmailMessage
 # EMAIL SENDING ENGINE (DYNAMIC)
 #-------------------------------------------------------------------------------#
 def send_email(email, business_name, user_email, app_password, email_content, city):
-    """Sends a personalized email using credentials provided from the frontend."""
+    """
+    Sends a personalized email using credentials provided from the frontend.
+    Raises on failure so the caller can queue a retry.
+    """
     if not email or email == "N/A":
         return
     
@@ -28,15 +34,24 @@ def send_email(email, business_name, user_email, app_password, email_content, ci
     msg['To'] = to_email
     msg.set_content(body)
 
+    # Wait for our slot in the Gmail sending budget
+    acquire(SMTP_HOST)
     try:
         # Use Port 587 with starttls for better compatibility in 2026
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
+        with smtplib.SMTP(SMTP_HOST, 587) as server:
             server.starttls()
             server.login(from_email, app_password)
             server.send_message(msg)
             print(f"Email successfully sent to {business_name} ({to_email})")
+            report_success(SMTP_HOST)
             return True
+    except smtplib.SMTPResponseException as e:
+        # 4xx means Gmail wants us to slow down (e.g. 421 / 450 / 451)
+        if 400 <= e.smtp_code < 500:
+            report_blocked(SMTP_HOST)
+        print(f"Failed to send to {to_email}: {e}")
+        raise
     except Exception as e:
         print(f"Failed to send to {to_email}: {e}")
-        return False
+        raise
     
@@ -1,8 +1,18 @@
 import pytest
 import uuid
 import sys
+import time
+import socket
+import smtplib
+import threading
 from playwright.sync_api import sync_playwright
 from scraper import extract_email_from_page
+import pandas as pd
+import exporter
+from exporter import export_key, get_csv_bytes, get_pdf_bytes
+import throttle
+from throttle import HostBucket, host_key
+import retry_queue
 from database import check_db_for_name, get_or_create_global_lead, link_lead_to_user, lead_is_new_for_this_sender
 
 # --- 1. TEST EMAIL EXTRACTION ---
@@ -27,6 +37,175 @@ def test_email_regex():
     assert "image@test.png" not in emails
     print("\n✅ Email Regex Test Passed")
 
+# --- 1b. TEST CACHED EXPORTS ---
+def test_export_cache():
+    """Tests that exports are keyed by content and served from the cache."""
+    df = pd.DataFrame([{"name": f"Lead {i}", "email": f"info@lead{i}.de"} for i in range(60)])
+    key = export_key(df, "Plumbers", "Berlin")
+
+    assert key == export_key(df.copy(), "Plumbers", "Berlin")
+    assert key != export_key(df, "Plumbers", "Munich")
+    assert key != export_key(df.head(59), "Plumbers", "Berlin")
+
+    csv_data = get_csv_bytes(df, key)
+    assert csv_data.startswith(b"name,email")
+    assert get_csv_bytes(df, key) is csv_data
+
+    pdf_data = get_pdf_bytes(df, "Plumbers", "Berlin", key)
+    assert pdf_data.startswith(b"%PDF")
+    assert get_pdf_bytes(df, "Plumbers", "Berlin", key) is pdf_data
+    print("\n✅ Export Cache Test Passed")
+
+def _wait_for_pdf_job(key, timeout=10):
+    deadline = time.time() + timeout
+    while key in exporter._pdf_jobs and time.time() < deadline:
+        time.sleep(0.05)
+
+def test_export_background_render(monkeypatch):
+    """Tests the background PDF path, including a failed render that must not loop."""
+    monkeypatch.setattr(exporter, "BACKGROUND_ROW_THRESHOLD", 10)
+    df = pd.DataFrame([{"name": f"Big Lead {i}", "email": f"info@big{i}.de"} for i in range(30)])
+
+    # Hold the worker until we've seen the "still rendering" answer
+    release = threading.Event()
+    renders = []
+    real_report = exporter.create_pdf_report
+    def slow_report(*args):
+        renders.append(args)
+        release.wait(10)
+        return real_report(*args)
+    monkeypatch.setattr(exporter, "create_pdf_report", slow_report)
+
+    key = export_key(df, "Plumbers", "Hamburg")
+    assert get_pdf_bytes(df, "Plumbers", "Hamburg", key) is None
+    release.set()
+    _wait_for_pdf_job(key)
+    pdf_data = get_pdf_bytes(df, "Plumbers", "Hamburg", key)
+    assert pdf_data.startswith(b"%PDF")
+    assert get_pdf_bytes(df, "Plumbers", "Hamburg", key) is pdf_data
+    assert len(renders) == 1
+
+    # A failed render is cached and re-raised instead of being resubmitted
+    calls = []
+    release = threading.Event()
+    def broken_report(*args):
+        calls.append(args)
+        release.wait(10)
+        raise ValueError("font missing")
+    monkeypatch.setattr(exporter, "create_pdf_report", broken_report)
+
+    key = export_key(df, "Plumbers", "Bremen")
+    assert get_pdf_bytes(df, "Plumbers", "Bremen", key) is None
+    release.set()
+    _wait_for_pdf_job(key)
+    for _ in range(3):
+        with pytest.raises(RuntimeError, match="font missing"):
+            get_pdf_bytes(df, "Plumbers", "Bremen", key)
+    assert len(calls) == 1
+
+    # An explicit retry clears the failure and renders again
+    release.clear()
+    exporter.retry_pdf(key)
+    assert get_pdf_bytes(df, "Plumbers", "Bremen", key) is None
+    release.set()
+    _wait_for_pdf_job(key)
+    with pytest.raises(RuntimeError):
+        get_pdf_bytes(df, "Plumbers", "Bremen", key)
+    assert len(calls) == 2
+    print("\n✅ Background Export Test Passed")
+
+# --- 1c. TEST PER-HOST THROTTLE ---
+def test_throttle_buckets():
+    """Tests host budgets, token refill and adaptive backoff without sleeping."""
+    assert host_key("https://www.google.com/maps") == "google.com"
+    assert host_key("https://maps.google.com/") == "google.com"
+    assert host_key("smtp.gmail.com") == "smtp.gmail.com"
+    assert host_key("http://www.Example-Plumber.de:8080/kontakt") == "example-plumber.de"
+
+    bucket = HostBucket(rate=1.0, burst=2)
+    now = bucket.updated
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) >= 1.0          # burst spent, must wait for refill
+    assert bucket.reserve(now + 10) == 0       # tokens refilled
+
+    first = bucket.penalize(now + 10)
+    second = bucket.penalize(now + 10)
+    assert second == first * 2
+    assert bucket.reserve(now + 10) >= second  # waits out the cooldown
+    bucket.recover()
+    assert bucket.strikes == 1
+    print("\n✅ Throttle Test Passed")
+
+def test_throttle_shared_smtp_budget(tmp_path, monkeypatch):
+    """Tests that the SMTP budget is shared through SQLite, not per process."""
+    monkeypatch.setattr(throttle, "SHARED_DB", str(tmp_path / "throttle.db"))
+    monkeypatch.setattr(throttle, "JITTER", 0)
+    rate = throttle.HOST_POLICIES["smtp.gmail.com"][0]
+
+    assert throttle._reserve_shared("smtp.gmail.com", rate) == 0
+    # A second process sees the booked slot and has to queue behind it
+    assert throttle._reserve_shared("smtp.gmail.com", rate) == pytest.approx(1 / rate, abs=1)
+
+    throttle._penalize_shared("smtp.gmail.com", 120)
+    assert throttle._reserve_shared("smtp.gmail.com", rate) >= 119
+    print("\n✅ Shared SMTP Budget Test Passed")
+
+# --- 1d. TEST RETRY QUEUE & DEAD LETTERS ---
+def test_retry_queue(tmp_path, monkeypatch):
+    """Tests error classification, backoff rescheduling and the dead-letter table."""
+    monkeypatch.setattr(retry_queue, "QUEUE_DB", str(tmp_path / "queue.db"))
+
+    assert retry_queue.classify_error(Exception("Timeout 15000ms exceeded.")) == "timeout"
+    assert retry_queue.classify_error(Exception("net::ERR_NAME_NOT_RESOLVED")) == "dns"
+    assert retry_queue.classify_error(socket.gaierror("no host")) == "dns"
+    assert retry_queue.classify_error(retry_queue.BlockedError("429")) == "blocked"
+    assert retry_queue.classify_error(smtplib.SMTPDataError(451, b"try later")) == "smtp_4xx"
+    assert retry_queue.classify_error(smtplib.SMTPDataError(550, b"no such user")) == "smtp_5xx"
+
+    sender, other_sender = "a@gmail.com", "b@gmail.com"
+
+    # SMTP 5xx is permanent and skips the queue
+    retry_queue.enqueue("send", {"email": "bad@lead.de"}, smtplib.SMTPDataError(550, b"no such user"), sender)
+    assert retry_queue.queue_stats(sender) == {"pending": 0, "dead": 1}
+
+    # Timeouts are retried with backoff until the policy gives up
+    monkeypatch.setattr(retry_queue, "RETRY_POLICY", {**retry_queue.RETRY_POLICY, "timeout": (2, 0)})
+    retry_queue.enqueue("crawl", {"name": "Slow GmbH", "website": "http://slow.de"}, Exception("Timeout"), sender)
+    assert retry_queue.queue_stats(sender) == {"pending": 1, "dead": 1}
+
+    calls = []
+    def flaky_crawl(payload):
+        calls.append(payload["name"])
+        raise Exception("Timeout again")
+
+    assert retry_queue.drain({"crawl": flaky_crawl}, sender, deadline=10) == 0
+    assert calls == ["Slow GmbH"]
+    assert retry_queue.queue_stats(sender) == {"pending": 0, "dead": 2}
+
+    # A drain never touches another sender's items (it holds the wrong password)
+    retry_queue.enqueue("send", {"email": "ok@lead.de"}, smtplib.SMTPDataError(421, b"busy"), sender)
+    later = lambda: 10**12  # past every backoff window
+    assert retry_queue.drain({"send": lambda payload: True}, other_sender, deadline=10, clock=later) == 0
+    assert retry_queue.queue_stats(sender) == {"pending": 1, "dead": 2}
+    assert retry_queue.queue_stats(other_sender) == {"pending": 0, "dead": 0}
+
+    # A successful retry by the owning sender removes the item
+    assert retry_queue.drain({"send": lambda payload: True}, sender, deadline=10, clock=later) == 1
+    assert retry_queue.queue_stats(sender) == {"pending": 0, "dead": 2}
+
+    # Handlers that finish without saving a lead (no email, skipped) aren't counted
+    retry_queue.enqueue("crawl", {"name": "Empty GmbH"}, Exception("Timeout"), sender)
+    assert retry_queue.drain({"crawl": lambda payload: False}, sender, deadline=10) == 0
+    assert retry_queue.queue_stats(sender) == {"pending": 0, "dead": 2}
+
+    # The drain can't add more leads than the campaign's Lead Count left over
+    retry_queue.set_campaign_quota("campaign-1", 1)
+    assert retry_queue.take_campaign_slot("campaign-1") is True
+    assert retry_queue.take_campaign_slot("campaign-1") is False
+    assert retry_queue.take_campaign_slot("unknown-campaign") is False
+    print("\n✅ Retry Queue Test Passed")
+
 # --- 2. TEST SUPABASE GLOBAL & USER LOGIC ---
 def test_supabase_integration():
     """Tests the full cloud flow: Global Insert -> User Linking -> Permission Check."""
@@ -79,6 +258,8 @@ if __name__ == "__main__":
     # Run them all
     try:
         test_email_regex()
+        test_export_cache()
+        test_throttle_buckets()
         test_supabase_integration()
         test_live_site_access()
         print("\n🚀 ALL TESTS PASSED SUCCESSFULLY")
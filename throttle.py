@@ -0,0 +1,152 @@
+import random
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+#-------------------------------------------------------------------------------#
+# CONFIGURATION
+#-------------------------------------------------------------------------------#
+# Request budgets per host: (requests per second, burst size)
+# Subdomains share the budget of their parent entry (maps.google.com -> google.com)
+HOST_POLICIES = {
+    "google.com": (0.5, 1),        # Maps feed scrolling
+    "smtp.gmail.com": (1 / 7, 1),  # 2026 Deliverability Tip: 5-10 seconds is safer for Gmail
+}
+# Every individual business website gets its own bucket with this budget
+DEFAULT_POLICY = (1.0, 2)
+
+# Hosts whose budget is shared by every process on this machine (the campaign
+# and the background `scraper.py --drain` both send mail). Their slots live in
+# SQLite instead of process memory, one slot per 1/rate seconds (no bursts).
+SHARED_HOSTS = ("smtp.gmail.com",)
+SHARED_DB = "throttle.db"
+
+# Random extra wait of up to this fraction of the refill interval
+JITTER = 0.3
+
+# Adaptive backoff after a 429 / CAPTCHA / consent wall (seconds)
+BASE_BACKOFF = 5
+MAX_BACKOFF = 300
+
+#-------------------------------------------------------------------------------#
+# TOKEN BUCKET
+#-------------------------------------------------------------------------------#
+class HostBucket:
+    """Jittered token bucket with an adaptive penalty window for one host."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.strikes = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """Takes one token and returns how long the caller has to wait for it."""
+        self._refill(now)
+        self.tokens -= 1
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 0:
+            wait = max(wait, -self.tokens / self.rate)
+        if wait > 0:
+            wait += random.uniform(0, JITTER / self.rate)
+        return wait
+
+    def penalize(self, now):
+        self.strikes += 1
+        delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (self.strikes - 1))
+        self.blocked_until = max(self.blocked_until, now + delay)
+        self.tokens = min(self.tokens, 0.0)
+        return delay
+
+    def recover(self):
+        self.strikes = max(0, self.strikes - 1)
+
+#-------------------------------------------------------------------------------#
+# SCHEDULER
+#-------------------------------------------------------------------------------#
+_buckets = {}
+_lock = threading.Lock()
+
+def host_key(target):
+    """Normalizes a URL or hostname to the host whose budget it draws from."""
+    target = str(target).strip().lower()
+    host = urlparse(target).hostname if "://" in target else target.split(":")[0]
+    host = (host or "").removeprefix("www.")
+    for policy_host in HOST_POLICIES:
+        if host == policy_host or host.endswith("." + policy_host):
+            return policy_host
+    return host
+
+def _shared_db():
+    conn = sqlite3.connect(SHARED_DB, timeout=30, isolation_level=None)
+    conn.execute("CREATE TABLE IF NOT EXISTS host_slots (host TEXT PRIMARY KEY, next_slot_at REAL NOT NULL)")
+    return conn
+
+def _reserve_shared(key, rate):
+    """Books the next free slot for a shared host and returns how long to wait for it."""
+    now = time.time()
+    conn = _shared_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT next_slot_at FROM host_slots WHERE host = ?", (key,)).fetchone()
+        slot = max(now, row[0] if row else 0.0)
+        conn.execute("INSERT OR REPLACE INTO host_slots (host, next_slot_at) VALUES (?, ?)", (key, slot + 1 / rate))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    wait = slot - now
+    if wait > 0:
+        wait += random.uniform(0, JITTER / rate)
+    return wait
+
+def _penalize_shared(key, delay):
+    conn = _shared_db()
+    try:
+        conn.execute(
+            "INSERT INTO host_slots (host, next_slot_at) VALUES (?, ?) "
+            "ON CONFLICT(host) DO UPDATE SET next_slot_at = MAX(next_slot_at, excluded.next_slot_at)",
+            (key, time.time() + delay),
+        )
+    finally:
+        conn.close()
+
+def _bucket(key):
+    if key not in _buckets:
+        rate, burst = HOST_POLICIES.get(key, DEFAULT_POLICY)
+        _buckets[key] = HostBucket(rate, burst)
+    return _buckets[key]
+
+def acquire(target):
+    """Blocks until the host behind `target` has capacity. Returns the time waited."""
+    key = host_key(target)
+    with _lock:
+        if key in SHARED_HOSTS:
+            wait = _reserve_shared(key, HOST_POLICIES[key][0])
+        else:
+            wait = _bucket(key).reserve(time.monotonic())
+    if wait > 0:
+        time.sleep(wait)
+    return wait
+
+def report_blocked(target):
+    """Backs the host off exponentially after a rate limit or bot wall."""
+    key = host_key(target)
+    with _lock:
+        delay = _bucket(key).penalize(time.monotonic())
+        if key in SHARED_HOSTS:
+            # Other processes must honour the cooldown too
+            _penalize_shared(key, delay)
+    print(f"🐢 [THROTTLE] {key} is pushing back, cooling down for {delay:.0f}s.")
+    return delay
+
+def report_success(target):
+    """Lets the host's backoff decay after a clean response."""
+    with _lock:
+        _bucket(host_key(target)).recover()